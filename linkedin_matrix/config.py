@@ -53,6 +53,7 @@ class Config(BaseBridgeConfig):
         copy("bridge.initial_chat_sync")
         copy("bridge.invite_own_puppet_to_pm")
         copy("bridge.mute_bridging")
+        copy("bridge.puppet_info_sync_interval")
         copy("bridge.resend_bridge_info")
         copy("bridge.set_topic_on_dms")
         copy("bridge.sync_direct_chat_list")
@@ -1,11 +1,23 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, AsyncGenerator, AsyncIterable, Awaitable, cast
-from datetime import datetime
-import re
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Awaitable,
+    ClassVar,
+    MutableMapping,
+    cast,
+)
+from collections import OrderedDict
+from functools import cached_property
+import asyncio
+import logging
+import time
 
 from linkedin_messaging import URN
-from linkedin_messaging.api_objects import MessagingMember, Picture
+from linkedin_messaging.api_objects import MessagingMember, VectorImage
 from yarl import URL
 import aiohttp
 import magic
@@ -22,6 +34,31 @@ from .db import Puppet as DBPuppet
 if TYPE_CHECKING:
     from .__main__ import LinkedInBridge
 
+MIME_SNIFF_SIZE = 2048
+AVATAR_CACHE_TTL = 30 * 60
+AVATAR_CACHE_SIZE = 1000
+SAVE_DELAY = 2.0
+PUPPET_CACHE_SIZE = 10_000
+
+
+# Tags records with the puppet's URN without registering a separate logger for every puppet
+# in the global logging manager (those are never freed).
+class PuppetLogAdapter(logging.LoggerAdapter):
+    def process(self, msg: Any, kwargs: MutableMapping[str, Any]) -> tuple[Any, MutableMapping]:
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return f"[{self.extra['li_member_urn']}] {msg}", kwargs
+
+    def trace(self, msg: Any, *args, **kwargs):
+        msg, kwargs = self.process(msg, kwargs)
+        self.logger.trace(msg, *args, **kwargs)
+
+
+def _get_vector_image(info: MessagingMember) -> VectorImage | None:
+    picture = info.alternate_image
+    if picture is None and info.mini_profile is not None:
+        picture = info.mini_profile.picture
+    return picture.vector_image if picture is not None else None
+
 
 class Puppet(DBPuppet, BasePuppet):
     bridge: LinkedInBridge
@@ -29,11 +66,21 @@ class Puppet(DBPuppet, BasePuppet):
     config: Config
     hs_domain: str
     mxid_template: SimpleTemplate[str]
-
-    by_li_member_urn: dict[URN, "Puppet"] = {}
-    by_custom_mxid: dict[UserID, "Puppet"] = {}
+    displayname_preference: tuple[str, ...]
+    displayname_template: str
+    info_sync_interval: float
+
+    # Least recently used first. Bounded by PUPPET_CACHE_SIZE, see _trim_cache.
+    by_li_member_urn: ClassVar[OrderedDict[URN, Puppet]] = OrderedDict()
+    by_custom_mxid: ClassVar[dict[UserID, Puppet]] = {}
+    # photo_id -> (uploaded avatar, upload time from time.monotonic()), oldest upload first
+    _avatar_mxc_cache: ClassVar[OrderedDict[str, tuple[ContentURI, float]]] = OrderedDict()
+    _avatar_uploads: ClassVar[dict[str, asyncio.Task[ContentURI]]] = {}
+    # Puppets with a pending delayed save. _trim_cache never evicts these.
+    _pending_saves: ClassVar[dict[URN, Puppet]] = {}
 
     session: aiohttp.ClientSession
+    mime_magic: magic.Magic
 
     def __init__(
         self,
@@ -64,13 +111,27 @@ class Puppet(DBPuppet, BasePuppet):
             contact_info_set,
             is_registered,
         )
-        self._last_info_sync: datetime | None = None
+        self._last_info_sync: float = 0.0
+        self._last_info_key: tuple[str | None, ...] | None = None
+        self._dirty = False
+        self._save_handle: asyncio.TimerHandle | None = None
+        self._save_task: asyncio.Task | None = None
+
+        self.log = PuppetLogAdapter(self.log, {"li_member_urn": str(self.li_member_urn)})
+
+    # These are computed on first use since most puppets loaded at startup are only cached.
 
-        self.default_mxid = self.get_mxid_from_id(li_member_urn)
-        self.default_mxid_intent = self.az.intent.user(self.default_mxid)
-        self.intent = self._fresh_intent()
+    @cached_property
+    def default_mxid(self) -> UserID:
+        return self.get_mxid_from_id(self.li_member_urn)
 
-        self.log = self.log.getChild(str(self.li_member_urn))
+    @cached_property
+    def default_mxid_intent(self) -> IntentAPI:
+        return self.az.intent.user(self.default_mxid)
+
+    @cached_property
+    def intent(self) -> IntentAPI:
+        return self._fresh_intent()
 
     @classmethod
     def init_cls(cls, bridge: "LinkedInBridge") -> AsyncIterable[Awaitable[None]]:
@@ -87,6 +148,9 @@ class Puppet(DBPuppet, BasePuppet):
             suffix=f":{Puppet.hs_domain}",
             type=str,
         )
+        cls.displayname_preference = tuple(cls.config["bridge.displayname_preference"])
+        cls.displayname_template = cls.config["bridge.displayname_template"]
+        cls.info_sync_interval = int(cls.config["bridge.puppet_info_sync_interval"]) * 60
         cls.sync_with_custom_puppets = cls.config["bridge.sync_with_custom_puppets"]
         cls.homeserver_url_map = {
             server: URL(url)
@@ -98,12 +162,21 @@ class Puppet(DBPuppet, BasePuppet):
             for server, secret in cls.config["bridge.login_shared_secret_map"].items()
         }
         cls.login_device_name = "LinkedIn Messages Bridge"
-        cls.session = aiohttp.ClientSession()
+        # Avatars all come from the same CDN, so keep the connections around for reuse.
+        cls.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+        )
+        cls.mime_magic = magic.Magic(mime=True)
 
         return (puppet.try_start() async for puppet in Puppet.get_all_with_custom_mxid())
 
     @classmethod
     async def close(cls):
+        # Puppets stay in _pending_saves until their save has finished, so this also waits
+        # for flushes that are already running before the database is stopped.
+        puppets = list(cls._pending_saves.values())
+        await asyncio.gather(*(puppet._flush_save() for puppet in puppets))
+        await asyncio.gather(*(puppet._save_task for puppet in puppets if puppet._save_task))
         await cls.session.close()
 
     def intent_for(self, portal: "p.Portal") -> IntentAPI:
@@ -123,21 +196,84 @@ class Puppet(DBPuppet, BasePuppet):
     ) -> "Puppet":
         assert source
 
-        self._last_info_sync = datetime.now()
-        try:
-            changed = await self._update_contact_info(info)
-            changed = await self._update_name(info) or changed
+        mini_profile = info.mini_profile
+        vector_image = _get_vector_image(info) if update_avatar else None
+        photo_url = None
+        if vector_image and vector_image.artifacts:
+            photo_url = (
+                vector_image.root_url
+                + vector_image.artifacts[-1].file_identifying_url_path_segment
+            )
+        info_key = (
+            info.alternate_name,
+            mini_profile.first_name if mini_profile else None,
+            mini_profile.last_name if mini_profile else None,
+            photo_url,
+        )
+        if (
+            info_key == self._last_info_key
+            and time.monotonic() - self._last_info_sync < self.info_sync_interval
+        ):
+            return self
+
+        self._last_info_sync = time.monotonic()
+        # The profile fields are independent, so update them concurrently. Collect errors
+        # instead of raising so that the changes from the other updates still get saved.
+        updates = [self._update_contact_info(info)]
+        failed = False
+        if mini_profile is None:
+            # Without a mini profile the name can't be built and the missing picture doesn't
+            # mean that the avatar was removed, so only update the contact info.
+            self.log.error(
+                f"No mini_profile found for {info.entity_urn} from source {source.li_member_urn}"
+            )
+            failed = True
+        else:
+            updates.append(self._update_name(info))
             if update_avatar:
-                photo = info.alternate_image or (
-                    info.mini_profile.picture if info.mini_profile else None
+                updates.append(self._update_photo(vector_image))
+        results = await asyncio.gather(*updates, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                failed = True
+                self.log.error(
+                    f"Failed to update info from source {source.li_member_urn}",
+                    exc_info=result,
                 )
-                changed = await self._update_photo(photo) or changed
+        if any(result is True for result in results):
+            self._mark_dirty()
+        # Only throttle once everything went through, otherwise the next sync should retry.
+        if not failed and self.name_set and (self.avatar_set or not update_avatar):
+            self._last_info_key = info_key
+        return self
 
-            if changed:
+    def _mark_dirty(self):
+        # Backfills often update the same puppet several times in a row, so coalesce the
+        # resulting database writes into one.
+        self._dirty = True
+        if self._save_handle is None:
+            self._pending_saves[self.li_member_urn] = self
+            self._save_handle = self.loop.call_later(SAVE_DELAY, self._start_flush)
+
+    def _start_flush(self):
+        self._save_handle = None
+        self._save_task = asyncio.create_task(self._flush_save())
+
+    async def _flush_save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        try:
+            if self._dirty:
+                self._dirty = False
                 await self.save()
         except Exception:
-            self.log.exception(f"Failed to update info from source {source.li_member_urn}")
-        return self
+            self.log.exception("Failed to save puppet")
+        finally:
+            # Changes made during the save schedule another one, which keeps the entry.
+            if self._save_handle is None:
+                self._pending_saves.pop(self.li_member_urn, None)
 
     async def _update_contact_info(self, info: MessagingMember, force: bool = False) -> bool:
         if not self.bridge.homeserver_software.is_hungry:
@@ -165,12 +301,26 @@ class Puppet(DBPuppet, BasePuppet):
         return True
 
     async def reupload_avatar(self, intent: IntentAPI, url: str) -> ContentURI:
-        async with self.session.get(url) as req:
-            if not req.ok:
+        # Several portals often sync the same participant at once, so share a single
+        # download and upload between all of the concurrent callers for the same URL.
+        task = self._avatar_uploads.get(url)
+        if task is None:
+            task = asyncio.create_task(self._reupload_avatar(intent, url))
+            self._avatar_uploads[url] = task
+            task.add_done_callback(lambda _: self._avatar_uploads.pop(url, None))
+        # Shield the shared task so that one caller being cancelled doesn't fail the others.
+        return await asyncio.shield(task)
+
+    async def _reupload_avatar(self, intent: IntentAPI, url: str) -> ContentURI:
+        # The images are already compressed, so don't make the CDN gzip them again.
+        async with self.session.get(url, headers={"Accept-Encoding": "identity"}) as resp:
+            if not resp.ok:
                 raise Exception(f"Couldn't download avatar for {self.li_member_urn}: {url}")
 
-            image_data = await req.content.read()
-            mime = magic.from_buffer(image_data, mime=True)
+            image_data = await resp.read()
+            # The image signature is always at the start of the file, so only sniff the first
+            # couple of KiB instead of the whole payload.
+            mime = self.mime_magic.from_buffer(image_data[:MIME_SNIFF_SIZE])
             return await intent.upload_media(
                 image_data, mime_type=mime, async_upload=self.config["homeserver.async_media"]
             )
@@ -199,46 +349,84 @@ class Puppet(DBPuppet, BasePuppet):
             "first_name": info.alternate_name or first,
             "last_name": last or "",
         }
-        for preference in cls.config["bridge.displayname_preference"]:
-            pref = info_map.get(preference)
-            if pref:
-                info_map["displayname"] = pref
-                break
-        return cls.config["bridge.displayname_template"].format(**info_map)
+        info_map["displayname"] = next(
+            (info_map[pref] for pref in cls.displayname_preference if info_map.get(pref)),
+            info_map["displayname"],
+        )
+        return cls.displayname_template.format_map(info_map)
+
+    @staticmethod
+    def _parse_photo_id(url: str) -> str | None:
+        # URLs look like https://<host>/<...>/image/<photo_id>/(profile|spinmail)-<...>
+        if not url.startswith("https://"):
+            return None
+        _, sep, rest = url.partition("/image/")
+        if not sep:
+            return None
+        for kind in ("/profile-", "/spinmail-"):
+            photo_id, sep, _ = rest.partition(kind)
+            if sep:
+                return photo_id
+        return None
 
-    photo_id_re = re.compile(r"https://.*?/image/(.*?)/(profile|spinmail)-.*?")
+    @classmethod
+    def _get_cached_avatar(cls, photo_id: str) -> ContentURI | None:
+        cached = cls._avatar_mxc_cache.get(photo_id)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[1] >= AVATAR_CACHE_TTL:
+            del cls._avatar_mxc_cache[photo_id]
+            return None
+        return cached[0]
+
+    @classmethod
+    def _cache_avatar(cls, photo_id: str, mxc: ContentURI):
+        cache = cls._avatar_mxc_cache
+        now = time.monotonic()
+        cache.pop(photo_id, None)
+        cache[photo_id] = (mxc, now)
+        # Entries are ordered by upload time, so the expired ones are always at the front.
+        while cache:
+            _, (_, uploaded_at) = next(iter(cache.items()))
+            if len(cache) <= AVATAR_CACHE_SIZE and now - uploaded_at < AVATAR_CACHE_TTL:
+                break
+            cache.popitem(last=False)
 
-    async def _update_photo(self, picture: Picture | None) -> bool:
+    async def _update_photo(self, vi: VectorImage | None) -> bool:
         photo_id = None
-        if picture and (vi := picture.vector_image):
-            match = self.photo_id_re.match(vi.root_url)
+        if vi:
+            photo_id = self._parse_photo_id(vi.root_url)
             # Handle InMail pictures which don't have any root_url
-            if not match and len(vi.artifacts) > 0:
-                match = self.photo_id_re.match(vi.artifacts[0].file_identifying_url_path_segment)
-            if match:
-                photo_id = match.group(1)
+            if photo_id is None and len(vi.artifacts) > 0:
+                photo_id = self._parse_photo_id(vi.artifacts[0].file_identifying_url_path_segment)
+
+        if photo_id == self.photo_id and self.avatar_set:
+            return False
 
-        if photo_id != self.photo_id or not self.avatar_set:
-            self.photo_id = photo_id
+        self.photo_id = photo_id
 
-            if photo_id and picture and (vi := picture.vector_image):
+        if photo_id and vi:
+            cached = self._get_cached_avatar(photo_id)
+            if cached:
+                self.photo_mxc = cached
+            else:
                 largest_artifact = vi.artifacts[-1]
                 self.photo_mxc = await self.reupload_avatar(
                     self.default_mxid_intent,
                     (vi.root_url + largest_artifact.file_identifying_url_path_segment),
                 )
-            else:
-                self.photo_mxc = ContentURI("")
+                self._cache_avatar(photo_id, self.photo_mxc)
+        else:
+            self.photo_mxc = ContentURI("")
 
-            try:
-                await self.default_mxid_intent.set_avatar_url(self.photo_mxc)
-                self.avatar_set = True
-            except Exception:
-                self.log.exception("Failed to set avatar")
-                self.avatar_set = False
+        try:
+            await self.default_mxid_intent.set_avatar_url(self.photo_mxc)
+            self.avatar_set = True
+        except Exception:
+            self.log.exception("Failed to set avatar")
+            self.avatar_set = False
 
-            return True
-        return False
+        return True
 
     # endregion
 
@@ -248,6 +436,17 @@ class Puppet(DBPuppet, BasePuppet):
         self.by_li_member_urn[self.li_member_urn] = self
         if self.custom_mxid:
             self.by_custom_mxid[self.custom_mxid] = self
+        self._trim_cache()
+
+    @classmethod
+    def _trim_cache(cls):
+        cache = cls.by_li_member_urn
+        for _ in range(len(cache) - PUPPET_CACHE_SIZE):
+            li_member_urn, puppet = cache.popitem(last=False)
+            # Double puppets and puppets with an unsaved change must stay the only instance
+            # for their URN, so put them back at the recently used end instead.
+            if puppet.custom_mxid or li_member_urn in cls._pending_saves:
+                cache[li_member_urn] = puppet
 
     @classmethod
     @async_getter_lock
@@ -257,10 +456,10 @@ class Puppet(DBPuppet, BasePuppet):
         *,
         create: bool = True,
     ) -> Puppet | None:
-        try:
-            return cls.by_li_member_urn[li_member_urn]
-        except KeyError:
-            pass
+        cached = cls.by_li_member_urn.get(li_member_urn)
+        if cached is not None:
+            cls.by_li_member_urn.move_to_end(li_member_urn)
+            return cached
 
         puppet = cast(Puppet | None, await super().get_by_li_member_urn(li_member_urn))
         if puppet:
@@ -270,7 +469,9 @@ class Puppet(DBPuppet, BasePuppet):
         if create:
             puppet = cls(li_member_urn, None, None, None, False, False)
             await puppet.insert()
-            puppet._add_to_cache()
+            # New puppets never have a custom MXID, so only the URN cache needs updating.
+            cls.by_li_member_urn[li_member_urn] = puppet
+            cls._trim_cache()
             return puppet
 
         return None
@@ -285,10 +486,9 @@ class Puppet(DBPuppet, BasePuppet):
     @classmethod
     @async_getter_lock
     async def get_by_custom_mxid(cls, mxid: UserID) -> Puppet | None:
-        try:
-            return cls.by_custom_mxid[mxid]
-        except KeyError:
-            pass
+        cached = cls.by_custom_mxid.get(mxid)
+        if cached is not None:
+            return cached
 
         puppet = cast("Puppet", await super().get_by_custom_mxid(mxid))
         if puppet:
@@ -299,13 +499,15 @@ class Puppet(DBPuppet, BasePuppet):
 
     @classmethod
     async def get_all_with_custom_mxid(cls) -> AsyncGenerator["Puppet", None]:
-        puppets = await super().get_all_with_custom_mxid()
-        for puppet in cast(list[Puppet], puppets):
-            try:
-                yield cls.by_li_member_urn[puppet.li_member_urn]
-            except KeyError:
-                puppet._add_to_cache()
-                yield puppet
+        puppets = cast(list[Puppet], await super().get_all_with_custom_mxid())
+        # Populate the caches in one pass before handing anything out so that the consumer
+        # doesn't interleave cache checks with the startup work for each puppet.
+        new = [p for p in puppets if p.li_member_urn not in cls.by_li_member_urn]
+        cls.by_li_member_urn.update((p.li_member_urn, p) for p in new)
+        cls.by_custom_mxid.update((p.custom_mxid, p) for p in new if p.custom_mxid)
+        cls._trim_cache()
+        for puppet in puppets:
+            yield cls.by_li_member_urn[puppet.li_member_urn]
 
     @classmethod
     def get_id_from_mxid(cls, mxid: UserID) -> URN | None: